@@ -4,96 +4,76 @@ A simple python http server.
 @author Josh Trujillo
 """
 
+import asyncio
+import functools
+import hashlib
+import logging
+import logging.handlers
 import mimetypes
 import os
 from os.path import abspath
+import queue
 import socket
 import typing
 import io
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from file_cache import CachedFile, FileCache
 from headers import Headers
-from request import Request
-from response import Response
+from request import Request, parse_content_length
+from response import send_with_body
 
 SERVER_ROOT = os.path.abspath("www")
+_SERVER_ROOT_PREFIX = SERVER_ROOT + os.sep
 
-FILE_RESPONSE_TEMPLATE = """\
-HTTP/1.1 200 OK
-Content-type: {content_type}
-Content-length: {content_length}
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
 
-""".replace(
-    "\n", "\r\n"
-)
+logger = logging.getLogger(__name__)
 
-class HTTPWorker(Thread):
-    def __init__(self, connection_queue: Queue) -> None:
-        super().__init__(daemon=True)
-
-        self.connection_queue = connection_queue
-        self.runnint = False
-
-    def stop(self) -> None:
-        self.running = False
+HOST = "127.0.0.1"
+PORT = 9000
 
-    def run(self) -> None:
-        self.running = False
-        while self.running:
-            try:
-                client_sock, client_addr = self.connection_queue.get(timeout=1)
-            except Empty:
-                continue
+# Per-request diagnostics are logged at DEBUG.
+LOG_LEVEL = logging.INFO
 
-            try:
-                self.handle_client(client_sock, client_addr)
-            except Exception:
-                print(f"Unhandled error: {e}")
-                continue
-            finally:
-                self.connection_queue.task_done()
+# Send buffer size for client sockets. On Linux, setting SO_SNDBUF at all
+# turns off send buffer autotuning, so it's only applied when it's larger
+# than the autotuning maximum (the last field of net.ipv4.tcp_wmem). The
+# kernel also caps it at net.core.wmem_max.
+SEND_BUFFER_SIZE = 1 << 20
 
-    def handle_client(self, client_sock: socket.socket, client_addr: typing.Tuple[str, int]) -> None:
-        with client_sock:
-            try:
-                request = Request.from_socket(client_sock)
 
-def serve_file(sock: socket.socket, path: str) -> None:
+def _autotuned_send_buffer_max() -> typing.Optional[int]:
     """
-    Given a socket and the relative path to a file (relative to
-    SERVER_SOCK), send that file to the socket if it exists.
-    If the file doesn't exist, sent a "404 Not Found" response.
+    Return the largest send buffer TCP autotuning may grow to, or None if
+    the platform doesn't expose it.
     """
-    if path == "/":
-        path = "/index.html"
+    try:
+        with open("/proc/sys/net/ipv4/tcp_wmem") as f:
+            return int(f.read().split()[-1])
+    except (OSError, ValueError, IndexError):
+        return None
 
-    abspath = os.path.normpath(os.path.join(SERVER_ROOT, path.lstrip("/")))
-    if not abspath.startswith(SERVER_ROOT):
-        response = Response(status="404 Not Found", content="Not Found")
-        response.send(sock)
-        return
 
-    try:
-        with open(abspath, "rb") as f:
-            stat = os.fstat(f.fileno())
-            content_type, encoding = mimetypes.guess_type(abspath)
-            if content_type is None:
-                content_type = "application/octet-stream"
+_autotuned_max = _autotuned_send_buffer_max()
+_SET_SEND_BUFFER = _autotuned_max is None or SEND_BUFFER_SIZE > _autotuned_max
 
-            if encoding is not None:
-                content_type += f"; charset={encoding}"
+# Files up to this many bytes are kept in memory, up to a total of
+# FILE_CACHE_MAX_SIZE bytes of cached responses.
+FILE_CACHE_MAX_FILE_SIZE = 64 * 1024
+FILE_CACHE_MAX_SIZE = 16 * 1024 * 1024
 
-            response = Response(status="200 OK", body=f)
-            response.headers.add("content-type", content_type)
-            response.send(sock)
-            return
-    except FileNotFoundError:
-        response = Response(status="404 Not Found", content="Not Found")
-        response.send(sock)
-        return
+_FILE_CACHE = FileCache(FILE_CACHE_MAX_SIZE)
 
+# Seconds an idle keep-alive connection is held open waiting for the
+# next request.
+KEEP_ALIVE_TIMEOUT = 5
 
-HOST = "127.0.0.1"
-PORT = 9000
+CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
 
 RESPONSE = b"""\
 HTTP/1.1 200 OK
@@ -108,6 +88,7 @@ BAD_REQUEST_RESPONSE = b"""\
 HTTP/1.1 400 Bad Request
 Content-type: text/plain
 Content-length: 11
+Connection: close
 
 Bad Request""".replace(
     b"\n", b"\r\n"
@@ -125,55 +106,294 @@ Not Found""".replace(
 METHOD_NOT_ALLOWED_RESPONSE = b"""\
 HTTP/1.1 405 Method Not Allowed
 Content-type: text/plain
-Content-length: 17
+Content-length: 18
+Connection: close
 
 Method Not Allowed""".replace(
     b"\n", b"\r\n"
 )
 
-with socket.socket() as server_sock:
-    # Tell the kernel to reuse sockets that are in 'TIME_WAIT' state.
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    # Binds socket to address
-    server_sock.bind((HOST, PORT))
-
-    # 0 is the number of pending connections the socket may have before
-    # new connections are refused. Since this server is going to process
-    # one connection at a time, we want to refuse any additional connections
-    server_sock.listen(0)
-    print(f"Listening on {HOST}:{PORT}...")
-    print(f"Visit http://{HOST}:{PORT}/")
-
-    while True:
-        # Accept incomming connection
-        client_sock, client_addr = server_sock.accept()
-        print(f"Received connection from {client_addr}.")
-        with client_sock:
-            try:
-                request = Request.from_socket(client_sock)
-                if "100-continue" in request.headers.get("expect", ""):
-                    response = Response(status="100 Continue")
-                    response.send(client_sock)
+NOT_IMPLEMENTED_RESPONSE = b"""\
+HTTP/1.1 501 Not Implemented
+Content-type: text/plain
+Content-length: 15
+Connection: close
 
-                try:
-                    content_length = int(request.headers.get("content-length", "0"))
-                except ValueError:
-                    content_length = 0
+Not Implemented""".replace(
+    b"\n", b"\r\n"
+)
 
-                if content_length:
-                    body = request.body.read(content_length)
-                    print("Request Body", body)
+NOT_MODIFIED_TEMPLATE = """\
+HTTP/1.1 304 Not Modified
+ETag: {etag}
+
+""".replace(
+    "\n", "\r\n"
+)
+
+FILE_RESPONSE_TEMPLATE = """\
+HTTP/1.1 200 OK
+Content-type: {content_type}
+Content-length: """.replace(
+    "\n", "\r\n"
+)
+
+
+@functools.lru_cache(maxsize=256)
+def _response_prefix(ext: str) -> bytes:
+    """
+    Build the encoded response prefix, up to and including
+    "Content-length: ", for files with the given lowercase extension.
+    """
+    content_type, encoding = mimetypes.guess_type("x" + ext)
+    if content_type is None:
+        content_type = "application/octet-stream"
+
+    if encoding is not None:
+        content_type += f"; charset={encoding}"
+
+    return FILE_RESPONSE_TEMPLATE.format(content_type=content_type).encode("ascii")
+
+
+def _etag_matches(if_none_match: typing.Optional[str], etag: str) -> bool:
+    """
+    Check whether an If-None-Match header value matches an entity tag,
+    using the weak comparison If-None-Match calls for.
+    """
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+
+def _cache_file(abspath: str, f: typing.BinaryIO, stat: os.stat_result) -> CachedFile:
+    """
+    Read a small, already opened file into a CachedFile and store it in
+    _FILE_CACHE.
+    """
+    content = f.read()
+    etag = f'"{hashlib.sha1(content).hexdigest()}"'
+    ext = os.path.splitext(abspath)[1].lower()
+    response = b"".join(
+        [
+            _response_prefix(ext),
+            str(len(content)).encode("ascii"),
+            b"\r\nETag: ",
+            etag.encode("ascii"),
+            b"\r\n\r\n",
+            content,
+        ]
+    )
+    not_modified = NOT_MODIFIED_TEMPLATE.format(etag=etag).encode("ascii")
+    entry = CachedFile(response, not_modified, etag, stat.st_mtime_ns, len(content))
+    _FILE_CACHE.put(abspath, entry)
+    return entry
+
+
+async def _send_cached(
+    writer: asyncio.StreamWriter,
+    entry: CachedFile,
+    if_none_match: typing.Optional[str],
+) -> None:
+    """
+    Send a cached file, or "304 Not Modified" if if_none_match matches it.
+    """
+    if _etag_matches(if_none_match, entry.etag):
+        writer.write(entry.not_modified)
+    else:
+        writer.write(entry.response)
+    await writer.drain()
+
+
+async def serve_file(
+    writer: asyncio.StreamWriter,
+    path: str,
+    if_none_match: typing.Optional[str] = None,
+) -> None:
+    """
+    Given a stream writer and the relative path to a file (relative to
+    SERVER_ROOT), send that file to the writer if it exists.
+    If the file doesn't exist, sent a "404 Not Found" response.
+    Small files are served from memory and, when if_none_match matches
+    their ETag, answered with "304 Not Modified".
+    """
+    if path == "/":
+        path = "/index.html"
+
+    if "/../" in path or path.endswith("/.."):
+        writer.write(NOT_FOUND_RESPONSE)
+        await writer.drain()
+        return
+
+    abspath = os.path.normpath(SERVER_ROOT + "/" + path.lstrip("/"))
+    if not (abspath == SERVER_ROOT or abspath.startswith(_SERVER_ROOT_PREFIX)):
+        writer.write(NOT_FOUND_RESPONSE)
+        await writer.drain()
+        return
+
+    try:
+        entry = _FILE_CACHE.get(abspath)
+        if entry is not None:
+            # A single stat is enough to tell whether the cached copy
+            # is still current.
+            stat = os.stat(abspath)
+            if stat.st_mtime_ns == entry.mtime_ns and stat.st_size == entry.size:
+                await _send_cached(writer, entry, if_none_match)
+                return
+
+            _FILE_CACHE.discard(abspath)
+
+        with open(abspath, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size <= FILE_CACHE_MAX_FILE_SIZE:
+                entry = _cache_file(abspath, f, stat)
+                await _send_cached(writer, entry, if_none_match)
+                return
+
+            if _HAS_FADVISE:
+                # Ask for aggressive readahead since the whole file is sent.
+                os.posix_fadvise(f.fileno(), 0, stat.st_size, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(f.fileno(), 0, stat.st_size, os.POSIX_FADV_WILLNEED)
+            ext = os.path.splitext(abspath)[1].lower()
+            prefix = _response_prefix(ext)
+            head = prefix + str(stat.st_size).encode("ascii") + b"\r\n\r\n"
+            await send_with_body(writer, head, f, stat.st_size)
+            return
+    except (FileNotFoundError, IsADirectoryError):
+        _FILE_CACHE.discard(abspath)
+        writer.write(NOT_FOUND_RESPONSE)
+        await writer.drain()
+        return
 
+
+async def handle_client(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """
+    Serve requests on a newly accepted connection until the client
+    closes it, asks for it to be closed or leaves it idle for longer
+    than KEEP_ALIVE_TIMEOUT.
+    """
+    client_addr = writer.get_extra_info("peername")
+    client_sock = writer.get_extra_info("socket")
+    client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if _SET_SEND_BUFFER:
+        client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    logger.debug("Received connection from %s.", client_addr)
+
+    try:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # The request headers and any body share one deadline.
+                deadline = loop.time() + KEEP_ALIVE_TIMEOUT
+                request = await asyncio.wait_for(
+                    Request.from_reader(reader), KEEP_ALIVE_TIMEOUT
+                )
                 if request.method != "GET":
-                    response = Response(
-                        status="405 Method Not Allowed", content="Method Not Allowed"
+                    writer.write(METHOD_NOT_ALLOWED_RESPONSE)
+                    await writer.drain()
+                    break
+
+                # Chunked and other transfer codings aren't supported, and
+                # the body can't be framed without them.
+                if request.headers.get("transfer-encoding") is not None:
+                    writer.write(NOT_IMPLEMENTED_RESPONSE)
+                    await writer.drain()
+                    break
+
+                if "100-continue" in request.headers.get("expect", ""):
+                    writer.write(CONTINUE_RESPONSE)
+                    await writer.drain()
+
+                content_length = parse_content_length(
+                    request.headers.get("content-length", "0")
+                )
+                if content_length:
+                    # GET bodies have no meaning here, but they still have
+                    # to be consumed off the connection.
+                    await asyncio.wait_for(
+                        request.body.discard(content_length),
+                        deadline - loop.time(),
                     )
-                    response.send(client_sock)
-                    continue
-
-                serve_file(client_sock, request.path)
-            except Exception as e:
-                print(f"Failed to parse request: {e}")
-                response = Response(status="400 Bad Request", content="Bad Request")
-                response.send(client_sock)
+
+            except (EOFError, asyncio.TimeoutError):
+                break
+            except ValueError as e:
+                logger.debug("Failed to parse request: %s", e)
+                writer.write(BAD_REQUEST_RESPONSE)
+                await writer.drain()
+                break
+
+            try:
+                await serve_file(
+                    writer, request.path, request.headers.get("if-none-match")
+                )
+            except ConnectionError as e:
+                logger.debug("Connection from %s lost: %s", client_addr, e)
+                break
+            except Exception:
+                # Part of the response may already have been written, so
+                # the only safe way out is to drop the connection.
+                logger.exception("Failed to serve %s.", request.path)
+                break
+
+            # Only HTTP/1.1 connections are persistent by default.
+            if request.version != "HTTP/1.1":
+                break
+
+            if request.headers.get("connection", "").lower() == "close":
+                break
+    except ConnectionError as e:
+        logger.debug("Connection from %s lost: %s", client_addr, e)
+    except Exception:
+        logger.exception("Unhandled error.")
+    finally:
+        writer.close()
+
+
+def setup_logging(level: int) -> logging.handlers.QueueListener:
+    """
+    Route all log records through a queue to a background thread that
+    writes them to stderr, so logging never blocks the event loop.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
+
+async def main() -> None:
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, backlog=1024, reuse_address=True
+    )
+    logger.info("Listening on %s:%s...", HOST, PORT)
+    logger.info("Visit http://%s:%s/", HOST, PORT)
+
+    async with server:
+        await server.serve_forever()
+
+
+if uvloop is not None:
+    uvloop.install()
+
+listener = setup_logging(LOG_LEVEL)
+try:
+    asyncio.run(main())
+finally:
+    listener.stop()
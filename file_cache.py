@@ -0,0 +1,57 @@
+import collections
+import typing
+
+
+class CachedFile(typing.NamedTuple):
+    """
+    A small file held in memory.
+
+    Parameters:
+        response: The complete "200 OK" response, headers and body.
+        not_modified: The complete "304 Not Modified" response.
+        etag: The quoted entity tag of the file's contents.
+        mtime_ns: The file's modification time when it was cached.
+        size: The file's size in bytes.
+    """
+
+    response: bytes
+    not_modified: bytes
+    etag: str
+    mtime_ns: int
+    size: int
+
+
+class FileCache:
+    """
+    A least recently used cache of CachedFile entries keyed by path,
+    bounded by the total size of the cached responses.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._entries: "collections.OrderedDict[str, CachedFile]" = (
+            collections.OrderedDict()
+        )
+        self._size = 0
+
+    def get(self, path: str) -> typing.Optional[CachedFile]:
+        entry = self._entries.get(path)
+        if entry is not None:
+            self._entries.move_to_end(path)
+        return entry
+
+    def put(self, path: str, entry: CachedFile) -> None:
+        self.discard(path)
+        if len(entry.response) > self.max_size:
+            return
+
+        self._entries[path] = entry
+        self._size += len(entry.response)
+        while self._size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.response)
+
+    def discard(self, path: str) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._size -= len(entry.response)
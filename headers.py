@@ -1,30 +1,34 @@
 import typing
 
-from collections import defaultdict
-
-HeadersDict = typing.Dict[str, typing.List[str]]
+HeadersDict = typing.Dict[str, str]
 HeadersGenerator = typing.Generator[typing.Tuple[str, str], None, None]
 
 
 class Headers:
+    """
+    A mapping of lowercase header names to values. Only the last
+    value added for a given name is kept.
+    """
+
     def __init__(self) -> None:
-        self._headers = defaultdict(list)
+        self._headers: HeadersDict = {}
 
     def add(self, name: str, value: str) -> None:
-        self._headers[name.lower()].append(value)
+        """
+        Set a header. The name is expected to already be lowercase.
+        """
+        self._headers[name] = value
 
     def get_all(self, name: str) -> typing.List[str]:
-        return self._headers[name.lower()]
+        try:
+            return [self._headers[name]]
+        except KeyError:
+            return []
 
     def get(
         self, name: str, default: typing.Optional[str] = None
     ) -> typing.Optional[str]:
-        try:
-            return self.get_all(name)[-1]
-        except IndexError:
-            return default
+        return self._headers.get(name, default)
 
     def __iter__(self) -> HeadersGenerator:
-        for name, values in self._headers.items():
-            for value in values:
-                yield name, value
+        yield from self._headers.items()
@@ -1,105 +1,183 @@
-import io
-import socket
+import asyncio
 import typing
 
-from collections import defaultdict
 from headers import Headers
 
-
-class BodyReader(io.IOBase):
+_WELL_KNOWN_HEADERS = (
+    "accept",
+    "accept-charset",
+    "accept-encoding",
+    "accept-language",
+    "authorization",
+    "cache-control",
+    "connection",
+    "content-encoding",
+    "content-length",
+    "content-type",
+    "cookie",
+    "date",
+    "dnt",
+    "expect",
+    "forwarded",
+    "host",
+    "if-match",
+    "if-modified-since",
+    "if-none-match",
+    "if-range",
+    "if-unmodified-since",
+    "origin",
+    "pragma",
+    "range",
+    "referer",
+    "te",
+    "transfer-encoding",
+    "upgrade",
+    "upgrade-insecure-requests",
+    "user-agent",
+    "via",
+    "x-forwarded-for",
+    "x-requested-with",
+)
+
+# Maps the raw bytes of well-known header names, both lowercase and in
+# their conventional capitalization, to interned lowercase str names so
+# that the common headers can be looked up without lowercasing/decoding.
+_INTERN = {}
+for _name in _WELL_KNOWN_HEADERS:
+    _INTERN[_name.encode("ascii")] = _name
+    _INTERN[_name.title().encode("ascii")] = _name
+del _name
+
+
+class BodyReader:
     def __init__(
-        self, sock: socket.socket, *, buff: bytes = b"", bufsize: int = 16_384
+        self, reader: asyncio.StreamReader, *, bufsize: int = 16_384
     ) -> None:
-        self._sock = sock
-        self._buff = buff
+        self._reader = reader
         self._bufsize = bufsize
 
-    def readable(self) -> bool:
-        return True
-
-    def read(self, n: int) -> bytes:
+    async def read(self, n: int) -> bytes:
         """
         Read up to n number of bytes from the request body.
         """
-        while len(self._buff) < n:
-            data = self._sock.recv(self._bufsize)
-            if not data:
-                break
+        try:
+            return await self._reader.readexactly(n)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
 
-            self._buff += data
+    async def discard(self, n: int) -> None:
+        """
+        Read and throw away n bytes of the request body, at most bufsize
+        bytes at a time.
+
+        Raises:
+            EOFError: When the stream ends before n bytes are read.
+        """
+        while n > 0:
+            data = await self._reader.read(min(n, self._bufsize))
+            if not data:
+                raise EOFError("Connection closed.")
 
-        res, self._buff = self._buff[:n], self._buff[n:]
-        return res
+            n -= len(data)
 
 
 class Request(typing.NamedTuple):
     method: str
     path: str
+    version: str
     headers: Headers
     body: BodyReader
 
     @classmethod
-    def from_socket(cls, sock: socket.socket) -> "Request":
+    async def from_reader(cls, reader: asyncio.StreamReader) -> "Request":
         """
-        Read and parse the request from a socket object.
+        Read and parse the request from a stream reader.
 
         Raises:
             ValueError: When the request cannot be parsed.
         """
-        lines = iter_lines(sock)
+        block = await read_header_block(reader)
+        method, path, version, headers = parse_request(block)
+        body = BodyReader(reader)
+        return cls(
+            method=method, path=path, version=version, headers=headers, body=body
+        )
 
-        try:
-            request_line = next(lines).decode("ascii")
-        except StopIteration:
-            raise ValueError("Request line missing.")
+
+def parse_request(block: bytes) -> typing.Tuple[str, str, str, Headers]:
+    """
+    Parse a request line and headers block, without the terminating
+    empty line, into the method, the path, the HTTP version and the
+    headers.
+
+    Raises:
+        ValueError: When the block cannot be parsed.
+    """
+    lines = block.split(b"\r\n")
+    request_line = lines[0]
+    try:
+        method_b, path_b, version_b = request_line.split(b" ")
+        method = method_b.upper().decode("ascii")
+        path = path_b.decode("ascii")
+        version = version_b.decode("ascii")
+    except ValueError:
+        raise ValueError(f"Malformed request line {request_line!r}.")
+
+    headers = Headers()
+    for line in lines[1:]:
+        name_b, sep, value_b = line.partition(b":")
+        if not sep:
+            raise ValueError(f"Malformed header line {line!r}.")
 
         try:
-            method, path, _ = request_line.split(" ")
+            name = _INTERN.get(name_b) or name_b.lower().decode("ascii")
+            value = value_b.strip(b" \t").decode("ascii")
         except ValueError:
-            raise ValueError(f"Malformed request line {request_line!r}.")
-
-        headers = Headers()
-        buff = b""
-        while True:
-            try:
-                line = next(lines)
-            except StopIteration as e:
-                # StopIteration.value contains the return value of the generator.
-                buff = e.value
-                break
-
-            try:
-                name, _, value = line.decode("ascii").partition(":")
-                headers.add(name, value.lstrip())
-            except ValueError:
-                raise ValueError(f"Malformed header line {line!r}.")
-
-        body = BodyReader(sock, buff=buff)
-        return cls(method=method.upper(), path=path, headers=headers, body=body)
-
-
-def iter_lines(
-    sock: socket.socket, bufsize: int = 16_384
-) -> typing.Generator[bytes, None, bytes]:
+            raise ValueError(f"Malformed header line {line!r}.")
+
+        # Headers only keeps the last value, so a repeated Content-Length
+        # would otherwise silently override the first one.
+        if name == "content-length" and headers.get(name) is not None:
+            raise ValueError("Duplicate content-length header.")
+
+        headers.add(name, value)
+
+    return method, path, version, headers
+
+
+def parse_content_length(value: str) -> int:
+    """
+    Parse a Content-Length header value. Only plain ASCII digits are
+    accepted, unlike int() which also allows signs, whitespace,
+    underscores and non-ASCII digits.
+
+    Raises:
+        ValueError: When the value is not a valid content length.
     """
-    Given a socket, read all the individual CRLF-separated lines
-    and yield each one until an empty one is found. Returns the
-    remainder after the empty line.
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError(f"Malformed content length {value!r}.")
+
+    return int(value)
+
+
+async def read_header_block(reader: asyncio.StreamReader) -> bytes:
     """
-    buff = b""
-    while True:
-        data = sock.recv(bufsize)
-        if not data:
-            return b""
-
-        buff += data
-        while True:
-            try:
-                i = buff.index(b"\r\n")
-                line, buff = buff[:i], buff[i + 2 :]
-                if not line:
-                    return buff
-
-                yield line
-            except IndexError:
-                break
+    Read the request line and headers from a stream reader, up to and
+    excluding the empty line that ends them. Anything after the empty
+    line is left in the reader for the body.
+
+    Raises:
+        EOFError: When the stream ends before any data is read.
+        ValueError: When the stream ends early or the block is too long.
+    """
+    try:
+        block = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            raise EOFError("Connection closed.")
+
+        raise ValueError("Request line missing.")
+    except asyncio.LimitOverrunError:
+        raise ValueError("Request header too long.")
+
+    return block[:-4]
@@ -1,64 +1,79 @@
-import io
+import asyncio
 import typing
 import socket
-import os
 
-from headers import Headers
+_HAS_CORK = hasattr(socket, "TCP_CORK")
 
+# How many bytes of the body are written together with the headers.
+HEAD_BODY_SIZE = 16_384
+
+# How many bytes of a file are read at a time when it can't be sent with
+# sendfile.
+WRITE_CHUNK_SIZE = 65_536
 
-class Response:
-    """
-    An HTTP response.
 
-    Parameters:
-        status: The response status line. e.g., "200 OK".
-        headers: The response headers.
-        body: A file containing the response body.
-        content: A string representing the response body. If this is
-            provided, then body is ignored.
-        encoding: An encoding for the content, if provided.
+async def send_with_body(
+    writer: asyncio.StreamWriter, head: bytes, body: typing.IO, count: int
+) -> None:
     """
+    Write a serialized status line and headers followed by count bytes
+    of body to a stream writer.
+    """
+    if count <= 0:
+        writer.write(head)
+        await writer.drain()
+        return
 
-    def __init__(
-        self,
-        status: str,
-        headers: typing.Optional[Headers] = None,
-        body: typing.Optional[typing.IO] = None,
-        content: typing.Optional[str] = None,
-        encoding: str = "utf 8",
-    ) -> None:
+    loop = asyncio.get_running_loop()
+    sock = writer.get_extra_info("socket")
+    if _HAS_CORK:
+        # Hold back partial frames until all of the body has been queued
+        # so the response goes out in full-sized segments.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
 
-        self.status = status.encode()
-        self.headers = headers or Headers()
+    try:
+        # Hand the headers to the transport together with the start of
+        # the body, so they leave in a single send (sendmsg where the
+        # event loop implements writelines with it) instead of a header
+        # write followed by the first sendfile.
+        body.seek(0)
+        first = body.read(min(count, HEAD_BODY_SIZE))
+        if not first:
+            raise EOFError("File ended before its expected size.")
 
-        if content is not None:
-            self.body = io.BytesIO(content.encode(encoding))
-        elif body is None:
-            self.body = io.BytesIO()
+        writer.writelines([head, first])
+        offset, count = len(first), count - len(first)
+        if count > 0:
+            try:
+                # Uses os.sendfile on the transport's socket where the
+                # event loop supports it.
+                await loop.sendfile(writer.transport, body, offset, count)
+            except NotImplementedError:
+                # Some event loops, such as uvloop, don't implement sendfile.
+                await _write_file(writer, body, offset, count)
         else:
-            self.body = body
+            await writer.drain()
+    finally:
+        if _HAS_CORK:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
 
-    def send(self, sock: socket.socket) -> None:
-        """
-        Write this response to a socket.
-        """
-        content_length = self.headers.get("content-length")
-        if content_length is None:
-            try:
-                body_stat = os.fstat(self.body.fileno())
-                content_length = body_stat.st_size
-            except OSError:
-                self.body.seek(0, os.SEEK_END)
-                content_length = self.body.tell()
-                self.body.seek(0, os.SEEK_SET)
 
-            if content_length > 0:
-                self.headers.add("content-length", content_length)
+async def _write_file(
+    writer: asyncio.StreamWriter, body: typing.IO, offset: int, count: int
+) -> None:
+    """
+    Write count bytes of a file, starting at offset, to a stream writer
+    in chunks of at most WRITE_CHUNK_SIZE bytes.
 
-        headers = b"HTTP/1.1 " + self.status + b"\r\n"
-        for header_name, header_value in self.headers:
-            headers += f"{header_name}: {header_value}\r\n".encode()
+    Raises:
+        EOFError: When the file ends before count bytes are read.
+    """
+    body.seek(offset)
+    while count > 0:
+        chunk = body.read(min(count, WRITE_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("File ended before its expected size.")
 
-        sock.sendall(headers + b"\r\n")
-        if content_length > 0:
-            sock.sendfile(self.body)
+        writer.write(chunk)
+        await writer.drain()
+        count -= len(chunk)